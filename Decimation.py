@@ -0,0 +1,74 @@
+import numpy as np
+
+
+def lttb(x, y, threshold):
+
+    # Largest-Triangle-Three-Buckets: keeps the point in each bucket that spans the largest triangle with its
+    # neighbours, which preserves peaks and bends of the line. The left neighbour is the mean of the previous bucket
+    # rather than the previously kept point, so that every bucket is resolved at once instead of one by one.
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # interior points split into threshold - 2 buckets whose sizes differ by at most one
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    starts, stops = edges[:-1], edges[1:]
+    width = int((stops - starts).max())
+    members = starts[:, None] + np.arange(width)
+    valid = members < stops[:, None]
+    members = np.where(valid, members, starts[:, None])
+
+    counts = valid.sum(axis=1)
+    xm = np.where(valid, x[members], 0).sum(axis=1) / counts
+    ym = np.where(valid, y[members], 0).sum(axis=1) / counts
+
+    xa = np.concatenate([[x[0]], xm[:-1]])[:, None]
+    ya = np.concatenate([[y[0]], ym[:-1]])[:, None]
+    xc = np.concatenate([xm[1:], [x[-1]]])[:, None]
+    yc = np.concatenate([ym[1:], [y[-1]]])[:, None]
+
+    area = np.abs((xa - xc) * (y[members] - ya) - (xa - x[members]) * (yc - ya))
+    area[~valid] = -1
+
+    indices = np.empty(threshold, dtype=int)
+    indices[0] = 0
+    indices[-1] = n - 1
+    indices[1:-1] = members[np.arange(len(starts)), np.argmax(area, axis=1)]
+    return indices
+
+
+def decimate_view(x, y, budget, view=None, background=0.125):
+
+    # points inside the view (x0, x1, y0, y1) get most of the budget, the rest of the trail is kept coarse
+    n = len(x)
+    if n <= budget:
+        return np.arange(n)
+
+    if view is None:
+        return lttb(x, y, budget)
+
+    x0, x1, y0, y1 = view
+    inside = (x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)
+
+    # widen each visible run by one point so the line still crosses the edges of the view
+    inside[1:] |= inside[:-1].copy()
+    inside[:-1] |= inside[1:].copy()
+
+    visible = np.flatnonzero(inside)
+    hidden = np.flatnonzero(~inside)
+    edges = np.flatnonzero(np.diff(inside.astype(np.int8)))
+
+    coarse = max(3, int(budget * background))
+    keep = [np.array([0, n - 1]), edges, edges + 1]
+    if len(visible):
+        keep.append(visible[lttb(x[visible], y[visible], budget - coarse)])
+    if len(hidden):
+        keep.append(hidden[lttb(x[hidden], y[hidden], coarse)])
+
+    keep = np.unique(np.concatenate(keep))
+
+    # a trail crossing the view many times forces extra edge points, never send more than the budget
+    if len(keep) > budget:
+        keep = keep[lttb(x[keep], y[keep], budget)]
+
+    return keep
@@ -7,6 +7,8 @@ from bokeh.plotting import figure
 from bokeh.models import BoxZoomTool
 from bokeh.core.enums import TextAlign
 
+import os
+import time
 import inspect
 import pandas as pd
 from datetime import datetime
@@ -18,12 +20,18 @@ from models import StandardEphemerisModels
 class EphemerisApp:
 
     to_seconds = dict(Day=86400, Hour=3600, Minute=60, Second=1)
+    plane_axes = dict(XY=(0, 1), YZ=(1, 2), XZ=(0, 2))
+
+    # when set, every animation tick appends "pid, session, interval ms, duration ms" to this file (see loadtest.py)
+    tick_log = os.environ.get('TICK_LOG')
 
     def __init__(self):
 
         # app variables
         self.active = True
         self.playAnimation = None
+        self.trailTimeout = None
+        self.lastTick = None
         self.start_epoch = None
         self.stop_epoch = None
         self.current_epoch = None
@@ -129,23 +137,22 @@ class EphemerisApp:
         self.plot.line('px', 'pz', source=self.cum_source, line_width=2, line_alpha=0.5, color='red', name='XZOrbit').visible = False
         self.plot.line('py', 'pz', source=self.cum_source, line_width=2, line_alpha=0.5, color='red', name='YZOrbit').visible = False
 
+        for plot_range in [self.plot.x_range, self.plot.y_range]:
+            plot_range.on_change('start', self.update_trail_view)
+            plot_range.on_change('end', self.update_trail_view)
+
         self.plotLayout = column(self.plot, self.offset, sizing_mode="stretch_width")
         self.plotTab = Panel(child=self.plotLayout, title="Display")
 
         # create data table tab objects
-        fmt = NumberFormatter(format='0.000', text_align=TextAlign.right)
-        columns = [
-            TableColumn(field="index", title="Epoch", formatter=DateFormatter(format="%m/%d/%Y %H:%M:%S")),
-            TableColumn(field="px", title="PX", formatter=fmt, width=10),
-            TableColumn(field="py", title="PY", formatter=fmt),
-            TableColumn(field="pz", title="PZ", formatter=fmt),
-            TableColumn(field="vx", title="VX", formatter=fmt),
-            TableColumn(field="vy", title="VY", formatter=fmt),
-            TableColumn(field="vz", title="VZ", formatter=fmt)
-        ]
-
-        self.ephemerisTable = DataTable(source=self.table_source, columns=columns, sizing_mode="stretch_both")
-        self.ephemerisLayout = column(self.exportRange, self.ephemerisTable, sizing_mode="stretch_width")
+        self.tableMode = RadioButtonGroup(
+            labels=['Target', 'All Objects'],
+            active=0)
+
+        self.ephemerisTable = DataTable(source=self.table_source, columns=self.table_columns(),
+                                        sizing_mode="stretch_both")
+        self.ephemerisLayout = column(self.exportRange, self.tableMode, self.ephemerisTable,
+                                      sizing_mode="stretch_width")
         self.dataTab = Panel(child=self.ephemerisLayout, title="Table")
 
         self.kernels = Div()
@@ -170,6 +177,7 @@ class EphemerisApp:
         self.interval.on_change('value', self.update_epochs)
         self.update_button.on_click(self.update_onclick)
         self.tabs.on_change('active', self.update_button_type)
+        self.tableMode.on_change('active', self.update_ephemeris)
 
         self.inputs = column(self.model,
                              self.frames,
@@ -181,6 +189,21 @@ class EphemerisApp:
                              self.interval,
                              self.update_button)
 
+    @staticmethod
+    def table_columns(names=None):
+
+        fmt = NumberFormatter(format='0.000', text_align=TextAlign.right)
+        columns = [TableColumn(field="index", title="Epoch", formatter=DateFormatter(format="%m/%d/%Y %H:%M:%S"))]
+
+        # one group of state, range and range-rate columns per object in the All Objects mode
+        if names is None:
+            columns += [TableColumn(field=c, title=c.upper(), formatter=fmt) for c in SpiceProvider.STATE_COLUMNS]
+        else:
+            columns += [TableColumn(field=f"{name}_{c}", title=f"{name} {c.replace('_', ' ').upper()}", formatter=fmt)
+                        for name in names for c in SpiceProvider.SYSTEM_COLUMNS]
+
+        return columns
+
     def get_layout(self):
         return column(row([self.inputs, self.tabs]), self.infoDiv, sizing_mode='stretch_width')
 
@@ -201,6 +224,7 @@ class EphemerisApp:
         self.ephemeris_model = self.allowed_models[new]()
         self.spice_provider.set_meta_kernel(self.ephemeris_model.kernel)
         self.spice_provider.setSpiceIds(self.ephemeris_model.objects)
+        self.spice_provider.set_store(self.ephemeris_model.name)
 
         self.update_kenerls_tab()
 
@@ -249,7 +273,7 @@ class EphemerisApp:
         self.current_epoch = self.start_epoch + pd.Timedelta(seconds=(self.offset.value * scale_factor))
 
         if self.playAnimation is None:
-            SpiceProvider.reset_source(self.spice_provider.cum_source)
+            self.spice_provider.reset_trail()
 
         self.update_states(None, 0, 0)
 
@@ -261,12 +285,20 @@ class EphemerisApp:
         self.spice_provider.frame = self.frames.value
         self.spice_provider.correction = SpiceProvider.CORRECTIONS[self.vector.value]
 
-        if self.active:
+        if self.active and self.tableMode.active == 1:
+            self.spice_provider.fetch_system_states(
+                self.ephemeris_model.objects,
+                self.start_epoch,
+                self.stop_epoch,
+                self.interval.value)
+            self.ephemerisTable.columns = self.table_columns(self.spice_provider.system_names)
+        elif self.active:
             self.spice_provider.fetch_ephemeris_states(
                 self.target.value,
                 self.start_epoch,
                 self.stop_epoch,
                 self.interval.value)
+            self.ephemerisTable.columns = self.table_columns()
 
     def update_states(self, attr, old, new):
 
@@ -278,7 +310,10 @@ class EphemerisApp:
             self.spice_provider.fetch_target_states(
                 self.ephemeris_model.objects,
                 self.current_epoch,
-                self.target.value)
+                self.target.value,
+                self.start_epoch,
+                self.interval.value,
+                self.playAnimation is not None)
 
     def update_plot_view(self, attr, old, new):
 
@@ -288,11 +323,36 @@ class EphemerisApp:
         self.plot.select_one({"name": self.planes.labels[old] + "Orbit"}).visible = False
         self.plot.select_one({"name": self.planes.labels[new] + "Orbit"}).visible = True
 
+        self.spice_provider.set_trail_axes(EphemerisApp.plane_axes[self.planes.labels[new]])
+
+    def update_trail_view(self, attr, old, new):
+        # range updates arrive one attribute at a time, so wait for the view to settle before decimating
+        if self.trailTimeout is None:
+            self.trailTimeout = curdoc().add_timeout_callback(self.render_trail_view, 100)
+
+    def render_trail_view(self):
+        self.trailTimeout = None
+        view = (self.plot.x_range.start, self.plot.x_range.end, self.plot.y_range.start, self.plot.y_range.end)
+        if None not in view:
+            self.spice_provider.set_trail_view(view)
+
     def animate_update(self):
 
+        start = time.perf_counter()
+
         self.offset.value = 0 if self.offset.value > self.offset.end else self.offset.value + 1
         if self.offset.value == 0:
-            SpiceProvider.reset_source(self.spice_provider.cum_source)
+            self.spice_provider.reset_trail()
+
+        if EphemerisApp.tick_log is not None:
+            self.log_tick(start)
+
+    def log_tick(self, start):
+
+        interval = start - self.lastTick if self.lastTick is not None else 0
+        self.lastTick = start
+        with open(EphemerisApp.tick_log, 'a') as f:
+            f.write(f"{os.getpid()}\t{id(self)}\t{interval * 1000:.3f}\t{(time.perf_counter() - start) * 1000:.3f}\n")
 
     def animate(self, start=True):
         if self.update_button.label == 'Play' and start:
@@ -302,6 +362,7 @@ class EphemerisApp:
             self.update_button.label = 'Play'
             curdoc().remove_periodic_callback(self.playAnimation)
             self.playAnimation = None
+            self.lastTick = None
 
     def update_onclick(self):
         if self.tabs.active == 0:
@@ -0,0 +1,217 @@
+import os
+import re
+import sys
+import json
+import inspect
+import spiceypy
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+STORE_DIR = 'ephemeris'
+
+# days covered by the grid of each time step, starting at the model epoch. Finer steps cover the shorter durations
+# only, Second steps are always computed live since a single day of them is 86400 rows per object and center.
+STORE_SPANS = dict(Day=1825, Hour=90, Minute=1)
+
+# models whose epoch is the build time keep their Day grid useful for this long, rebuild them at least this often
+ROLLING_MARGIN_DAYS = 365
+
+
+class EphemerisStore(object):
+
+    # one store per model, shared by every session in the worker process
+    _stores = {}
+
+    def __init__(self, name, directory=STORE_DIR):
+
+        self.name = name
+        self.path = os.path.join(directory, EphemerisStore.slug(name))
+
+        self.objects = {}
+        self.grids = []
+        self.arrays = {}
+        self.kernel_set = ()
+        self.mismatched = set()
+
+        index = os.path.join(self.path, 'index.json')
+        if os.path.exists(index):
+            with open(index, 'r') as f:
+                meta = json.load(f)
+
+            self.objects = {str(spice_id): k for k, spice_id in enumerate(meta['objects'])}
+            self.kernel_set = tuple(tuple(k) for k in meta.get('kernels', []))
+
+            # coarsest grid first, it has the fewest pages to touch for a strided read
+            for grid in sorted(meta['grids'], key=lambda g: -g['step_seconds']):
+                self.grids.append(dict(start=pd.Timestamp(grid['start']), step=grid['step_seconds'],
+                                       count=grid['count'],
+                                       files={(e['frame'], e['center'], e['correction']): e['file']
+                                              for e in grid['entries']}))
+
+            if meta.get('rolling') and self.grids and \
+                    datetime.now() > pd.Timestamp(meta['built']) + pd.Timedelta(days=ROLLING_MARGIN_DAYS):
+                print(f"Warning: ephemeris store for {name} was built on {meta['built']}, rebuild it with "
+                      f"python EphemerisStore.py", flush=True)
+
+    @classmethod
+    def open(cls, name):
+        if name not in cls._stores:
+            cls._stores[name] = cls(name)
+        return cls._stores[name]
+
+    def matches(self, kernel_set):
+
+        # states are only served for the kernels the store was built from, not e.g. the synthetic kernels of
+        # loadtest.py or an updated S3 kernel loaded under the same model
+        if self.kernel_set == kernel_set:
+            return True
+
+        if self.grids and kernel_set not in self.mismatched:
+            self.mismatched.add(kernel_set)
+            print(f"Warning: ephemeris store for {self.name} was built from other kernels, computing states live",
+                  flush=True)
+
+        return False
+
+    @staticmethod
+    def slug(name):
+        return re.sub(r'[^a-z0-9]+', '_', name.lower()).strip('_')
+
+    def get_array(self, grid, frame, center, correction):
+
+        file = grid['files'].get((frame, str(center), correction))
+        if file is None:
+            return None
+
+        # read-only memory maps are backed by the OS page cache, so all workers share the same pages
+        if file not in self.arrays:
+            self.arrays[file] = np.load(os.path.join(self.path, file), mmap_mode='r')
+
+        return self.arrays[file]
+
+    @staticmethod
+    def get_index(grid, epoch):
+
+        offset = (pd.Timestamp(epoch) - grid['start']).total_seconds() / grid['step']
+        index = int(round(offset))
+        if abs(offset - index) > 1e-9 or index < 0 or index >= grid['count']:
+            return None
+
+        return index
+
+    @staticmethod
+    def get_indices(grid, epochs):
+
+        if len(epochs) == 0:
+            return None
+
+        first = EphemerisStore.get_index(grid, epochs[0])
+        last = EphemerisStore.get_index(grid, epochs[-1])
+        if first is None or last is None:
+            return None
+
+        if len(epochs) == 1:
+            return slice(first, first + 1)
+
+        # epochs come from pd.date_range, so checking the first step and the total span is enough
+        stride = EphemerisStore.get_index(grid, grid['start'] + (epochs[1] - epochs[0]))
+        if not stride or first + stride * (len(epochs) - 1) != last:
+            return None
+
+        return slice(first, last + 1, stride)
+
+    def fetch_states(self, target, epochs, frame, center, correction):
+
+        if str(target) not in self.objects:
+            return None
+
+        for grid in self.grids:
+            array = self.get_array(grid, frame, center, correction)
+            indices = EphemerisStore.get_indices(grid, epochs)
+            if array is not None and indices is not None:
+                return array[indices, self.objects[str(target)], :]
+
+        return None
+
+    def fetch_epoch_states(self, targets, epoch, frame, center, correction):
+
+        # one row of the grid holds every object, so a plot update is a single slice
+        if any(str(target) not in self.objects for target in targets):
+            return None
+
+        for grid in self.grids:
+            array = self.get_array(grid, frame, center, correction)
+            index = EphemerisStore.get_index(grid, epoch) if array is not None else None
+            if index is not None:
+                return array[index, [self.objects[str(target)] for target in targets], :]
+
+        return None
+
+    def build(self, model, spice_provider, frames=None, rolling=False):
+
+        os.makedirs(self.path, exist_ok=True)
+
+        start = pd.Timestamp(model.epoch).normalize()
+        correction = spice_provider.CORRECTIONS[model.vector_type]
+        objects = [str(spice_id) for spice_id in model.objects.values()]
+
+        spice_provider.set_meta_kernel(model.kernel)
+        spice_provider.correction = correction
+
+        grids = []
+        for interval, span in STORE_SPANS.items():
+            step = pd.Timedelta(1, unit=spice_provider.INTERVALS[interval])
+            span += ROLLING_MARGIN_DAYS if rolling and interval == 'Day' else 0
+            epochs = pd.date_range(start, start + pd.Timedelta(days=span), freq=step)
+            ets = [spice_provider.get_et(epoch.to_pydatetime()) for epoch in epochs]
+
+            entries = []
+            for frame in frames or model.FRAMES:
+                spice_provider.frame = frame
+                for center in objects:
+                    spice_provider.center = center
+                    file = f"{interval}_{frame}_{center}_{EphemerisStore.slug(correction)}.npy"
+                    array = np.lib.format.open_memmap(os.path.join(self.path, file), mode='w+',
+                                                      dtype=np.float64, shape=(len(epochs), len(objects), 6))
+                    try:
+                        for k, target in enumerate(objects):
+                            array[:, k, :] = spice_provider.fetch_et_states(target, ets)
+                    except spiceypy.utils.exceptions.SpiceyError as e:
+                        # e.g. a frame whose kernels are not part of the meta kernel
+                        print(f"{self.name}: skipped {frame}: {e.short}", flush=True)
+                        del array
+                        os.remove(os.path.join(self.path, file))
+                        break
+                    array.flush()
+                    del array
+
+                    entries.append(dict(frame=frame, center=center, correction=correction, file=file))
+                    print(f"{self.name}: wrote {file}", flush=True)
+
+            grids.append(dict(interval=interval, start=start.isoformat(), step_seconds=step.total_seconds(),
+                              count=len(epochs), entries=entries))
+
+        meta = dict(name=self.name, objects=objects, kernels=spice_provider.kernel_set, rolling=rolling, grids=grids,
+                    built=datetime.now().isoformat())
+        with open(os.path.join(self.path, 'index.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+
+if __name__ == '__main__':
+
+    from SpiceProvider import SpiceProvider
+    from models import StandardEphemerisModels
+
+    # usage: python EphemerisStore.py [model name ...]
+    # models whose epoch is datetime.now() are anchored at the build day, schedule this at least every
+    # ROLLING_MARGIN_DAYS days for them
+    functions = [f for _, f in inspect.getmembers(StandardEphemerisModels, inspect.isfunction)]
+    names = sys.argv[1:] or [f().name for f in functions]
+
+    provider = SpiceProvider()
+    for f in functions:
+        m = f()
+        if m.name in names:
+            rolling = abs((datetime.now() - m.epoch).total_seconds()) < 60
+            EphemerisStore(m.name).build(m, provider, rolling=rolling)
@@ -1,7 +1,16 @@
+import os
+import hashlib
 import spiceypy
+import numpy as np
 import pandas as pd
 import datetime as dt
 import s3manager
+import ApparentStates
+
+from EphemerisStore import EphemerisStore
+from SharedStateCache import SharedStateCache
+from Decimation import decimate_view
+from models.EphemerisModel import OrbitStateBatch
 
 from bokeh.models import ColumnDataSource
 
@@ -9,6 +18,10 @@ from bokeh.models import ColumnDataSource
 class SpiceProvider(object):
 
     STATE_COLUMNS = ['px', 'py', 'pz', 'vx', 'vy', 'vz']
+    SYSTEM_COLUMNS = STATE_COLUMNS + ['range', 'range_rate']
+    TRAIL_COLUMNS = ['px', 'py', 'pz']
+    TRAIL_BUDGET = 1000
+    TICK_BLOCK = 50
 
     CORRECTIONS = dict(Apparent='LT+S', Geometric='None')
     INTERVALS = dict(Day="D", Hour="H", Minute="T", Second="S")
@@ -17,21 +30,43 @@ class SpiceProvider(object):
                      SATURN=6, URANUS=7, NEPTUNE=8, PLUTO=9, JUNO=-61)
     SPICE_NAMES = {v: k for k, v in SPICE_IDS.items()}
 
+    # content digest of every kernel file this process has loaded, by (path, size, mtime)
+    _digests = {}
+
     def __init__(self):
 
         self.meta_kernel = None
+        self.loaded_kernel = None
         self.center = '10'
         self.frame = 'J2000'
         self.correction = 'LT+S'
+        self.store = None
+        self.kernel_set = ()
+        self.cache = SharedStateCache.open()
 
-        self.ephemeris_data = pd.DataFrame(columns=SpiceProvider.STATE_COLUMNS)
+        self.ephemeris_data = OrbitStateBatch([])
         self.ephemeris_source = ColumnDataSource()
 
-        self.state_data = pd.DataFrame(columns=SpiceProvider.STATE_COLUMNS+['radii'])
+        # epoch x body x SYSTEM_COLUMNS array of every object in the model, and one batch per body viewing into it
+        self.system_data = np.empty((0, 0, len(SpiceProvider.SYSTEM_COLUMNS)))
+        self.system_states = []
+        self.system_names = []
+
+        # states of every object at the current epoch, one row per object
+        self.state_data = OrbitStateBatch([])
+        self.state_names = []
+        self.tick_block = None
         self.state_source = ColumnDataSource()
 
-        self.cum_data = pd.DataFrame(columns=SpiceProvider.STATE_COLUMNS.append('radii'))
-        self.cum_source = ColumnDataSource(self.cum_data)
+        # full orbit trail history, only a decimated subset of it is sent to the plot
+        self.trail = np.empty((1024, 3))
+        self.trail_count = 0
+        self.trail_name = None
+        self.trail_axes = (0, 1)
+        self.trail_view = None
+        self.trail_rendered = 0
+
+        self.cum_source = ColumnDataSource(dict(index=[], px=[], py=[], pz=[]))
 
 
     def set_meta_kernel(self, kernel):
@@ -40,13 +75,38 @@ class SpiceProvider(object):
             return
 
         if self.meta_kernel is not None:
-            spiceypy.unload(self.meta_kernel)
+            spiceypy.unload(self.loaded_kernel)
 
         if kernel is not None:
-            s3manager.get_meta_kernel(kernel)
-            spiceypy.furnsh(kernel)
+            self.loaded_kernel = s3manager.get_meta_kernel(kernel)
+            spiceypy.furnsh(self.loaded_kernel)
 
         self.meta_kernel = kernel
+        self.kernel_set = tuple(SpiceProvider.kernel_digest(k[0]) for k in self.fetch_kernels())
+
+    @staticmethod
+    def kernel_digest(path):
+
+        # kernels are identified by content, a kernel rewritten under the same name (a new S3 upload, loadtest.py
+        # --make-kernels) must not match states cached or stored from the old one. Downloads change the mtime, so it
+        # only decides when a file is hashed again.
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return path, None
+
+        stamp = (path, stat.st_size, stat.st_mtime_ns)
+        if stamp not in SpiceProvider._digests:
+            digest = hashlib.blake2b(digest_size=16)
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            SpiceProvider._digests[stamp] = digest.hexdigest()
+
+        return path, SpiceProvider._digests[stamp]
+
+    def set_store(self, name):
+        self.store = EphemerisStore.open(name) if name is not None else None
 
     def set_center(self, center):
         self.center = self.fromName(center)
@@ -58,16 +118,119 @@ class SpiceProvider(object):
 
         return spiceypy.str2et(utctime)
 
-    def fetch_state(self, target, epoch):
+    def use_store(self):
+        return self.store is not None and self.store.matches(self.kernel_set)
 
-        target = self.fromName(target)
+    def fetch_stored_states(self, target, epochs):
+
+        if not self.use_store():
+            return None
+
+        return self.store.fetch_states(target, epochs, self.frame, self.center, self.correction)
+
+    def fetch_stored_epoch_states(self, targets, epoch):
+
+        if not self.use_store():
+            return None
+
+        states = self.store.fetch_epoch_states(targets, epoch, self.frame, self.center, self.correction)
+        return states if states is not None and not np.any(np.isnan(states)) else None
+
+    def fetch_et_states(self, target, ets, correction=None, center=None):
+
+        correction = correction or self.correction
+        center = center or self.center
+        ets = [float(et) for et in ets]
         try:
-            state, lt = spiceypy.spkezr(str(target), self.get_et(epoch), self.frame, self.correction, str(self.center))
+            states, lts = spiceypy.spkezr(str(target), ets, self.frame, correction, str(center))
         except spiceypy.utils.exceptions.SpiceSPKINSUFFDATA:
-            print(f"Insufficient SPICE data exception was raised for {target} at {epoch}", flush=True)
-            state = [None]*6
+            # fall back to one epoch at a time so that only the uncovered epochs are lost
+            print(f"Insufficient SPICE data exception was raised for {target} over {len(ets)} epochs", flush=True)
+            states = [[np.nan]*6]*len(ets)
+            for k, et in enumerate(ets):
+                try:
+                    states[k], lt = spiceypy.spkezr(str(target), et, self.frame, correction, str(center))
+                except spiceypy.utils.exceptions.SpiceSPKINSUFFDATA:
+                    pass
+
+        return np.array(states, dtype=np.float64).reshape(len(ets), 6)
+
+    def fetch_ssb_states(self, target, ets):
+        return self.fetch_et_states(target, ets, 'NONE', '0')
+
+    def fetch_apparent_states(self, targets, ets, geometric=None):
+
+        # one geometric pass at the observation epochs and one at the light-time corrected epochs per target,
+        # the observer states are shared by all targets. Given the geometric states relative to the center, the
+        # light time is taken from them and the first pass is skipped.
+        ets = np.asarray(ets, dtype=np.float64)
+        observer = self.fetch_ssb_states(self.center, ets)
+        observer_acc = (self.fetch_ssb_states(self.center, ets + ApparentStates.TDELTA)[:, 3:] -
+                        self.fetch_ssb_states(self.center, ets - ApparentStates.TDELTA)[:, 3:]) / \
+            (2 * ApparentStates.TDELTA)
+
+        retarded = np.empty((len(ets), len(targets), 6))
+        for k, target in enumerate(targets):
+            position = geometric[:, k, :3] if geometric is not None else \
+                self.fetch_ssb_states(target, ets)[:, :3] - observer[:, :3]
+            lt = ApparentStates.light_time(position)
+            retarded[:, k, :] = self.fetch_ssb_states(target, ets - np.nan_to_num(lt))
+            retarded[np.isnan(lt), k, :] = np.nan
+
+        # the corrections run once over every (epoch, target) pair
+        with np.errstate(invalid='ignore'):
+            states = ApparentStates.apparent_states(retarded.reshape(-1, 6), np.repeat(observer, len(targets), axis=0),
+                                                    np.repeat(observer_acc, len(targets), axis=0))
+
+        return states.reshape(len(ets), len(targets), 6)
+
+    def fetch_shared_states(self, targets, date_range, compute):
+
+        key = self.shared_key(targets, date_range, self.correction)
+        states = self.cache.get(key) if self.cache is not None else None
+        if states is None:
+            states = compute([self.get_et(epoch.to_pydatetime()) for epoch in date_range])
+            if self.cache is not None:
+                self.cache.put(key, states)
+
+        return states
+
+    def shared_key(self, targets, date_range, correction):
+        # states computed by any worker on the host are shared through the cache, keyed by everything they depend on
+        return (self.kernel_set, tuple(targets), self.center, self.frame, correction,
+                date_range[0].isoformat(), str(date_range.freq), len(date_range))
+
+    def fetch_geometric_states(self, targets, date_range):
 
-        return {k: v for k, v in zip(SpiceProvider.STATE_COLUMNS, state)}
+        # geometric states relative to the center that are at hand without spkezr, from the store or from a
+        # Geometric grid of the same targets some worker has put into the cache
+        if self.use_store():
+            stored = [self.store.fetch_states(target, date_range, self.frame, self.center, 'None')
+                      for target in targets]
+            if all(states is not None for states in stored):
+                return np.stack(stored, axis=1)
+
+        return self.cache.get(self.shared_key(targets, date_range, 'None')) if self.cache is not None else None
+
+    def fetch_grid_states(self, targets, date_range, ets):
+
+        if self.correction == 'LT+S' and self.frame in ApparentStates.INERTIAL_FRAMES:
+            geometric = self.fetch_geometric_states(targets, date_range)
+            if ApparentStates.engine_wins(len(targets), len(ets), geometric is not None):
+                return self.fetch_apparent_states(targets, ets, geometric)
+
+        return np.stack([self.fetch_et_states(target, ets) for target in targets], axis=1)
+
+    def validate_apparent_states(self, target, ets, geometric=False):
+
+        # largest position and velocity differences of the batched engine against spkezr, with the light time from
+        # the engine's own geometric pass or from given geometric states
+        target = self.fromName(target)
+        states = self.fetch_et_states(target, ets, 'NONE')[:, None, :] if geometric else None
+        batched = self.fetch_apparent_states([target], ets, states)[:, 0, :]
+        reference = self.fetch_et_states(target, ets, 'LT+S')
+        error = np.abs(batched - reference)
+        return np.nanmax(error[:, :3]), np.nanmax(error[:, 3:])
 
     def fetch_ephemeris_states(self, target, epoch_start, epoch_stop, interval):
 
@@ -75,25 +238,164 @@ class SpiceProvider(object):
             return
 
         date_range = pd.date_range(epoch_start, epoch_stop, freq=SpiceProvider.INTERVALS[interval])[:500]
-        states = {epoch: self.fetch_state(target, epoch) for epoch in date_range}
 
-        self.ephemeris_data = pd.DataFrame.from_dict(states, orient='index')
-        self.ephemeris_source.data = self.ephemeris_data.reset_index().to_dict(orient='list')
+        target = self.fromName(target)
+        states = self.fetch_stored_states(target, date_range)
+        if states is None:
+            states = self.fetch_shared_states([target], date_range,
+                                              lambda ets: self.fetch_grid_states([target], date_range, ets))
+            states = states[:, 0, :]
+
+        self.ephemeris_data = OrbitStateBatch.fromStates(date_range.values, states)
+        self.ephemeris_source.data = self.ephemeris_data.toSourceData(SpiceProvider.STATE_COLUMNS)
+
+    def compute_system_states(self, ids, date_range, ets):
+
+        # light time and aberration depend on the observer, corrected states cannot be differenced
+        if self.correction != 'None':
+            return self.fetch_grid_states(ids, date_range, ets)
+
+        # one SSB-relative pass per body, geometric states relative to the center follow by subtraction
+        center = self.fetch_ssb_states(self.center, ets)
+        return np.stack([self.fetch_ssb_states(target, ets) for target in ids], axis=1) - center[:, None, :]
+
+    def fetch_system_states(self, targets, epoch_start, epoch_stop, interval):
+
+        if interval not in SpiceProvider.INTERVALS:
+            return
+
+        date_range = pd.date_range(epoch_start, epoch_stop, freq=SpiceProvider.INTERVALS[interval])[:500]
+        ids = [self.fromName(target) for target in targets]
+
+        stored = [self.fetch_stored_states(target, date_range) for target in ids]
+        if all(states is not None for states in stored):
+            states = np.stack(stored, axis=1)
+        else:
+            states = self.fetch_shared_states(ids, date_range,
+                                              lambda ets: self.compute_system_states(ids, date_range, ets))
+
+        # the batches share one (epoch, body, 13) buffer, each body is a strided view into it
+        buffer = np.full((len(date_range), len(ids), len(OrbitStateBatch.COLUMNS)), np.nan)
+        buffer[:, :, :6] = states
+        self.system_states = [OrbitStateBatch.fromArray(date_range.values, buffer[:, k, :]) for k in range(len(ids))]
+        self.system_names = [self.fromId(target) for target in targets]
+
+        distance = np.linalg.norm(states[:, :, :3], axis=2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            range_rate = np.where(distance > 0, np.sum(states[:, :, :3] * states[:, :, 3:], axis=2) / distance, 0)
+        self.system_data = np.concatenate([states, distance[:, :, None], range_rate[:, :, None]], axis=2)
+
+        data = dict(index=date_range.values)
+        for k, (name, batch) in enumerate(zip(self.system_names, self.system_states)):
+            data.update(batch.toSourceData(SpiceProvider.STATE_COLUMNS, prefix=f"{name}_"))
+            data[f"{name}_range"] = distance[:, k]
+            data[f"{name}_range_rate"] = range_rate[:, k]
+        self.ephemeris_source.data = data
+
+    def fetch_tick_states(self, targets, epoch, epoch_start, interval, playing):
+
+        # animation ticks step through the grid of the ephemeris table, blocks of TICK_BLOCK epochs of it are computed
+        # at once so that only the first tick of a block pays for spkezr. A new block is only computed while playing
+        # or next to the current one, a scrub elsewhere would pay TICK_BLOCK epochs for one. Blocks stay in the
+        # worker, in the shared cache they would evict the table grids.
+        if epoch_start is None or interval not in SpiceProvider.INTERVALS:
+            return None
+
+        step = pd.Timedelta(1, unit=SpiceProvider.INTERVALS[interval])
+        offset = (pd.Timestamp(epoch) - pd.Timestamp(epoch_start)) / step
+        if offset < 0 or offset != int(offset):
+            return None
+
+        block, index = divmod(int(offset), SpiceProvider.TICK_BLOCK)
+
+        key = (self.kernel_set, tuple(targets), self.center, self.frame, self.correction, epoch_start, interval)
+        current = self.tick_block is not None and self.tick_block[0] == key
+        if not (current and self.tick_block[1] == block):
+            if not playing and not (current and abs(self.tick_block[1] - block) == 1):
+                return None
+
+            date_range = pd.date_range(pd.Timestamp(epoch_start) + block * SpiceProvider.TICK_BLOCK * step,
+                                       periods=SpiceProvider.TICK_BLOCK, freq=SpiceProvider.INTERVALS[interval])
+            ets = [self.get_et(e.to_pydatetime()) for e in date_range]
+            self.tick_block = (key, block, self.fetch_grid_states(targets, date_range, ets))
+
+        return self.tick_block[2][index]
+
+    def fetch_target_states(self, targets, epoch, prime_target=None, epoch_start=None, interval=None, playing=False):
+
+        ids = [self.fromName(target) for target in targets]
+        states = self.fetch_stored_epoch_states(ids, epoch)
+        if states is None:
+            states = self.fetch_tick_states(ids, epoch, epoch_start, interval, playing)
+        if states is None:
+            et = self.get_et(epoch)
+            states = np.vstack([self.fetch_et_states(target, [et]) for target in ids])
+
+        self.state_data = OrbitStateBatch.fromStates([epoch] * len(ids), states)
+        self.state_names = [self.fromId(target) for target in targets]
+
+        radii = np.array(self.fetch_radii(targets), dtype=np.float64)
+        radii = np.maximum(radii / radii.max() * 12, 4)
+
+        data = self.state_data.toSourceData(SpiceProvider.STATE_COLUMNS, index=self.state_names)
+        data['radii'] = radii
+        self.state_source.data = data
+
+        if prime_target is not None and prime_target in self.state_names:
+            position = self.state_data.getPosition()[self.state_names.index(prime_target)]
+            self.append_trail(prime_target, position)
+
+    def append_trail(self, name, position):
+
+        position = np.array(position, dtype=np.float64)
+        if np.any(np.isnan(position)):
+            return
+
+        if self.trail_count == len(self.trail):
+            self.trail = np.concatenate([self.trail, np.empty_like(self.trail)])
 
-    def fetch_target_states(self, targets, epoch, prime_target=None):
+        self.trail[self.trail_count] = position
+        self.trail_count += 1
+        self.trail_name = name
 
-        states = {self.fromId(target): self.fetch_state(target, epoch) for target in targets}
+        # stream raw points until the plot holds twice the budget, then re-decimate the whole trail
+        if self.trail_rendered < 2 * SpiceProvider.TRAIL_BUDGET:
+            self.cum_source.stream(dict(index=[name], px=[position[0]], py=[position[1]], pz=[position[2]]))
+            self.trail_rendered += 1
+        else:
+            self.render_trail()
 
-        self.state_data = pd.DataFrame.from_dict(states, orient='index')
+    def render_trail(self):
 
-        self.state_data['radii'] = self.fetch_radii(targets)
-        self.state_data['radii'] = self.state_data['radii'] / self.state_data['radii'].max() * 12
-        self.state_data['radii'] = self.state_data['radii'].apply(lambda r: r if r > 4 else 4)
+        trail = self.trail[:self.trail_count]
+        keep = decimate_view(trail[:, self.trail_axes[0]], trail[:, self.trail_axes[1]],
+                             SpiceProvider.TRAIL_BUDGET, self.trail_view)
 
-        self.state_source.data = self.state_data.reset_index().to_dict(orient='list')
+        self.cum_source.data = dict(index=[self.trail_name] * len(keep), px=trail[keep, 0].tolist(),
+                                    py=trail[keep, 1].tolist(), pz=trail[keep, 2].tolist())
+        self.trail_rendered = len(keep)
 
-        if prime_target is not None:
-            self.cum_source.stream(self.state_data[self.state_data.index == prime_target], rollover=2000)
+    def set_trail_axes(self, axes):
+        self.trail_axes = axes
+        self.trail_view = None
+        self.render_trail()
+
+    def set_trail_view(self, view):
+
+        # ignore small pans and the auto-range creeping outwards as the trail grows
+        old = self.trail_view
+        if old is not None:
+            span = min(old[1] - old[0], old[3] - old[2])
+            if max(abs(n - o) for n, o in zip(view, old)) < 0.1 * span:
+                return
+
+        self.trail_view = view
+        self.render_trail()
+
+    def reset_trail(self):
+        self.trail_count = 0
+        self.trail_rendered = 0
+        self.cum_source.data = dict(index=[], px=[], py=[], pz=[])
 
     def fetch_radii(self, targets):
         targets = [self.fromName(t) for t in targets]
@@ -110,10 +412,6 @@ class SpiceProvider(object):
         count = spiceypy.ktotal('ALL')
         return [spiceypy.kdata(i, 'ALL') for i in range(count)]
 
-    @staticmethod
-    def reset_source(source):
-        source.data = pd.DataFrame(columns=SpiceProvider.STATE_COLUMNS)
-
     def setSpiceIds(self, newIds):
         self.SPICE_IDS = newIds
         self.SPICE_NAMES = {v: k for k, v in newIds.items()}
@@ -0,0 +1,329 @@
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+
+# usage:
+#   python loadtest.py --make-kernels
+#   python loadtest.py --launch --sessions 20 --duration 60
+#
+# Opens N bokeh.client sessions, each in its own process, against a local server. Players open the app with
+# ?autoplay so the server runs its 50 ms animate_update callback, browsers replay model switches, slider scrubs and
+# the Table tab. Frame timing comes from the TICK_LOG the server writes, so it measures the server callback and not
+# the client round trips. A server started elsewhere must run with KERNEL_SOURCE=local,
+# META_KERNEL=kernels/mk/synthetic.tm and TICK_LOG set, pass the same file with --tick-log.
+
+FRAME_BUDGET = 0.05
+SESSION_TIMEOUT = 60
+SYNTHETIC_META_KERNEL = 'kernels/mk/synthetic.tm'
+SYNTHETIC_MODELS = ["The Solar System", "Apparent Solar System", "Sun Earth-Moon System"]
+
+LEAPSECONDS = """KPL/LSK
+
+\\begindata
+
+DELTET/DELTA_T_A       =   32.184
+DELTET/K               =    1.657D-3
+DELTET/EB              =    1.671D-2
+DELTET/M               = (  6.239996D0   1.99096871D-7 )
+
+DELTET/DELTA_AT        = ( 10,   @1972-JAN-1
+                           11,   @1972-JUL-1
+                           12,   @1973-JAN-1
+                           13,   @1974-JAN-1
+                           14,   @1975-JAN-1
+                           15,   @1976-JAN-1
+                           16,   @1977-JAN-1
+                           17,   @1978-JAN-1
+                           18,   @1979-JAN-1
+                           19,   @1980-JAN-1
+                           20,   @1981-JUL-1
+                           21,   @1982-JUL-1
+                           22,   @1983-JUL-1
+                           23,   @1985-JUL-1
+                           24,   @1988-JAN-1
+                           25,   @1990-JAN-1
+                           26,   @1991-JAN-1
+                           27,   @1992-JUL-1
+                           28,   @1993-JUL-1
+                           29,   @1994-JUL-1
+                           30,   @1996-JAN-1
+                           31,   @1997-JUL-1
+                           32,   @1999-JAN-1
+                           33,   @2006-JAN-1
+                           34,   @2009-JAN-1
+                           35,   @2012-JUL-1
+                           36,   @2015-JUL-1
+                           37,   @2017-JAN-1 )
+
+\\begintext
+"""
+
+META_KERNEL = """KPL/MK
+
+\\begindata
+
+KERNELS_TO_LOAD = ( 'kernels/lsk/synthetic.tls',
+                    'kernels/spk/synthetic.bsp' )
+
+\\begintext
+"""
+
+# body: (center, radius km, period days, inclination deg)
+SYNTHETIC_ORBITS = {10: (0, 7.0e5, 4332.6, 1.3), 1: (0, 5.79e7, 88.0, 7.0), 2: (0, 1.082e8, 224.7, 3.4),
+                    3: (0, 1.496e8, 365.25, 0.0), 4: (0, 2.279e8, 687.0, 1.9), 5: (0, 7.785e8, 4332.6, 1.3),
+                    6: (0, 1.434e9, 10759.2, 2.5), 7: (0, 2.871e9, 30688.5, 0.8), 8: (0, 4.495e9, 60182.0, 1.8),
+                    399: (3, 4.67e3, 27.32, 5.1), 301: (3, 3.797e5, 27.32, 5.1)}
+
+
+def make_kernels():
+
+    import spiceypy
+
+    with open('kernels/lsk/synthetic.tls', 'w') as f:
+        f.write(LEAPSECONDS)
+    with open(SYNTHETIC_META_KERNEL, 'w') as f:
+        f.write(META_KERNEL)
+
+    spiceypy.furnsh('kernels/lsk/synthetic.tls')
+    ets = np.arange(spiceypy.str2et('1990-01-01'), spiceypy.str2et('2050-01-01'), 86400.0)
+
+    if os.path.exists('kernels/spk/synthetic.bsp'):
+        os.remove('kernels/spk/synthetic.bsp')
+    handle = spiceypy.spkopn('kernels/spk/synthetic.bsp', 'synthetic', 0)
+
+    # circular inclined orbits, evaluated analytically on a daily grid and interpolated by SPK type 9
+    for body, (center, radius, period, inclination) in SYNTHETIC_ORBITS.items():
+        n = 2 * np.pi / (period * 86400.0)
+        phase = n * ets + body
+        inc = np.radians(inclination)
+        if body == 399:
+            phase += np.pi
+
+        states = np.column_stack([radius * np.cos(phase),
+                                  radius * np.sin(phase) * np.cos(inc),
+                                  radius * np.sin(phase) * np.sin(inc),
+                                  -radius * n * np.sin(phase),
+                                  radius * n * np.cos(phase) * np.cos(inc),
+                                  radius * n * np.cos(phase) * np.sin(inc)])
+
+        spiceypy.spkw09(handle, body, center, 'J2000', ets[0], ets[-1], f'SYNTHETIC {body}', 7, len(ets),
+                        states.tolist(), ets.tolist())
+
+    spiceypy.spkcls(handle)
+    print(f"Wrote synthetic kernels, serve them with KERNEL_SOURCE=local META_KERNEL={SYNTHETIC_META_KERNEL}",
+          flush=True)
+
+
+def launch_server(port, num_procs, tick_log):
+    env = dict(os.environ, KERNEL_SOURCE='local', META_KERNEL=SYNTHETIC_META_KERNEL, TICK_LOG=tick_log)
+    server = subprocess.Popen([sys.executable, '-m', 'bokeh', 'serve', f'--port={port}', f'--num-procs={num_procs}',
+                               'main.py'], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(5)
+    return server
+
+
+def server_memory(pid):
+
+    # resident memory of the server and its forked workers, in MB
+    total = 0
+    pids = [pid]
+    while pids:
+        p = pids.pop()
+        try:
+            with open(f'/proc/{p}/status') as f:
+                total += next(int(line.split()[1]) for line in f if line.startswith('VmRSS'))
+            with open(f'/proc/{p}/task/{p}/children') as f:
+                pids += [int(c) for c in f.read().split()]
+        except (OSError, StopIteration):
+            pass
+
+    return total / 1024
+
+
+def run_session(url, duration, seed, player, results, loaded, release):
+
+    from bokeh.client import pull_session
+    from bokeh.models import Slider, Select, Tabs
+
+    latencies = dict(model=[], scrub=[], table=[])
+    session = None
+    error = None
+
+    def timed(action, change):
+        start = time.perf_counter()
+        change()
+        session.force_roundtrip()
+        latencies[action].append(time.perf_counter() - start)
+
+    try:
+        session = pull_session(url=url, arguments=dict(autoplay='1') if player else None)
+
+        document = session.document
+        model = document.select_one({'type': Select, 'title': 'Ephemeris Model'})
+        offset = document.select_one({'type': Slider})
+        tabs = document.select_one({'type': Tabs})
+        choice = random.Random(seed)
+
+        stop = time.perf_counter() + duration
+        while time.perf_counter() < stop:
+
+            # players only keep reading the frames the server pushes, the Table tab would stop their animation
+            if player:
+                session.force_roundtrip()
+                time.sleep(0.5)
+                continue
+
+            action = choice.choice(['model', 'scrub', 'scrub', 'table'])
+
+            if action == 'model':
+                name = choice.choice(SYNTHETIC_MODELS)
+                timed('model', lambda: setattr(model, 'value', name))
+
+            elif action == 'scrub':
+                values = range(int(offset.end) + 1)
+                for value in sorted(choice.sample(values, min(10, len(values)))):
+                    timed('scrub', lambda: setattr(offset, 'value', value))
+
+            elif action == 'table':
+                timed('table', lambda: setattr(tabs, 'active', 1))
+                timed('table', lambda: setattr(tabs, 'active', 0))
+
+    except Exception as e:
+        # exceptions do not always pickle, main only needs the message
+        error = f"{type(e).__name__}: {e}"
+
+    finally:
+        results.put((seed, error, latencies))
+        loaded.release()
+
+    # every client waits here, so one that is no longer alive has died before releasing. Sessions stay open until
+    # the server memory has been sampled.
+    release.wait()
+    if session is not None:
+        session.close()
+
+
+def read_ticks(tick_log):
+
+    # pid, session, interval ms, duration ms per animate_update call, the first tick of a session has no interval
+    if not os.path.exists(tick_log):
+        return np.zeros((0, 2))
+
+    ticks = np.loadtxt(tick_log, usecols=(2, 3), ndmin=2)
+    return ticks[ticks[:, 0] > 0]
+
+
+def report(latencies, ticks, sessions, players, elapsed, memory):
+
+    print(f"\n{sessions} sessions ({players} playing), {elapsed:.1f} s\n")
+    print(f"{'callback':<10}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+
+    rows = [(action, np.array(values) * 1000) for action, values in latencies.items()]
+    rows += [('tick', ticks[:, 1]), ('interval', ticks[:, 0])]
+    for action, values in rows:
+        if len(values):
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            print(f"{action:<10}{len(values):>8}{p50:>10.1f}{p90:>10.1f}{p99:>10.1f}{values.max():>10.1f}")
+
+    # a periodic callback that fires late has skipped round(interval / 50 ms) - 1 frames
+    budget = FRAME_BUDGET * 1000
+    late = ticks[:, 0] > 1.5 * budget
+    dropped = int(np.sum(np.round(ticks[late, 0] / budget) - 1))
+    frames = len(ticks) + dropped
+
+    total = sum(len(values) for values in latencies.values()) + len(ticks)
+    print(f"\nthroughput:       {total / elapsed:.1f} callbacks/s")
+    print(f"dropped frames:   {dropped} of {frames} ({100 * dropped / max(frames, 1):.1f} %)")
+    if memory is not None:
+        print(f"memory/session:   {memory:.1f} MB")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Simulate concurrent Astropynamics sessions.")
+    parser.add_argument('--make-kernels', action='store_true', help="write synthetic kernels and exit")
+    parser.add_argument('--sessions', type=int, default=10)
+    parser.add_argument('--players', type=float, default=0.5, help="fraction of the sessions that play")
+    parser.add_argument('--duration', type=float, default=30, help="seconds of scripted actions per session")
+    parser.add_argument('--url', default=None, help="defaults to the launched server")
+    parser.add_argument('--launch', action='store_true', help="start bokeh serve with the synthetic kernels")
+    parser.add_argument('--port', type=int, default=5006)
+    parser.add_argument('--num-procs', type=int, default=1)
+    parser.add_argument('--server-pid', type=int, default=None, help="pid used to measure server memory")
+    parser.add_argument('--tick-log', default=None, help="TICK_LOG of a server started elsewhere")
+    args = parser.parse_args()
+
+    if args.make_kernels:
+        make_kernels()
+        return
+
+    tick_log = args.tick_log or os.path.join(tempfile.mkdtemp(), 'ticks.tsv')
+    server = launch_server(args.port, args.num_procs, tick_log) if args.launch else None
+    url = args.url or f'http://localhost:{args.port}/main'
+    pid = server.pid if server is not None else args.server_pid
+    players = int(round(args.sessions * args.players))
+
+    try:
+        baseline = server_memory(pid) if pid is not None else None
+        if os.path.exists(tick_log):
+            os.remove(tick_log)
+
+        results = multiprocessing.Queue()
+        loaded = multiprocessing.Semaphore(0)
+        release = multiprocessing.Event()
+        clients = [multiprocessing.Process(target=run_session, daemon=True,
+                                           args=(url, args.duration, seed, seed < players, results, loaded, release))
+                   for seed in range(args.sessions)]
+
+        start = time.perf_counter()
+        for c in clients:
+            c.start()
+
+        # wait for every client that is still alive, but no longer than the scripted load and SESSION_TIMEOUT
+        done = 0
+        deadline = start + args.duration + SESSION_TIMEOUT
+        while done < len(clients):
+            if loaded.acquire(timeout=1):
+                done += 1
+            elif time.perf_counter() > deadline or done + sum(not c.is_alive() for c in clients) >= len(clients):
+                print(f"Error: {len(clients) - done} sessions died or did not finish, skipping them", flush=True)
+                break
+        elapsed = time.perf_counter() - start
+
+        # every session is still open here, so this is the memory the scripted load left behind
+        memory = server_memory(pid) if pid is not None else None
+        release.set()
+
+        latencies = dict(model=[], scrub=[], table=[])
+        failed = len(clients) - done
+        for _ in range(done):
+            seed, error, values = results.get()
+            if error is not None:
+                print(f"Error: session {seed} against {url} failed: {error}", flush=True)
+                failed += 1
+            for action, times in values.items():
+                latencies[action] += times
+
+        for c in clients:
+            c.join(timeout=5)
+            if c.is_alive():
+                c.terminate()
+
+        if memory is not None:
+            memory = (memory - baseline) / max(len(clients) - failed, 1)
+
+        report(latencies, read_ticks(tick_log), len(clients) - failed, players, elapsed, memory)
+
+    finally:
+        if server is not None:
+            server.terminate()
+
+
+if __name__ == '__main__':
+    main()
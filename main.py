@@ -5,3 +5,7 @@ from EphemerisApp import EphemerisApp
 ephemerisApp = EphemerisApp()
 curdoc().add_root(ephemerisApp.get_layout())
 
+# ?autoplay starts the animation straight away, e.g. for links and for loadtest.py
+if curdoc().session_context is not None and 'autoplay' in curdoc().session_context.request.arguments:
+    ephemerisApp.animate()
+
@@ -1,3 +1,4 @@
+import warnings
 import numpy as np
 from datetime import datetime
 
@@ -133,3 +134,136 @@ class OrbitState:
 
     def getEpoch(self):
         return self.epoch
+
+
+class OrbitStateBatch:
+
+    __slots__ = ['epochs', 'data']
+
+    COLUMNS = ['px', 'py', 'pz', 'vx', 'vy', 'vz', 'qs', 'qx', 'qy', 'qz', 'rx', 'ry', 'rz']
+    POSITION = slice(0, 3)
+    VELOCITY = slice(3, 6)
+    ATTITUDE = slice(6, 10)
+    RATE = slice(10, 13)
+
+    def __init__(self, epochs, position=None, velocity=None, attitude=None, rate=None):
+
+        # N epochs are stored as one contiguous (N, 13) array, the getters return views into it
+        self.epochs = np.asarray(epochs, dtype='datetime64[ns]').reshape(-1)
+        self.data = np.full((len(self.epochs), len(OrbitStateBatch.COLUMNS)), np.nan)
+
+        if position is not None:
+            self.setPosition(position)
+
+        if velocity is not None:
+            self.setVelocity(velocity)
+
+        if attitude is not None:
+            self.setAttitude(attitude)
+
+        if rate is not None:
+            self.setRate(rate)
+
+    @classmethod
+    def fromArray(cls, epochs, data):
+
+        # wraps an existing (N, 13) array without copying it
+        batch = cls.__new__(cls)
+        batch.epochs = np.asarray(epochs, dtype='datetime64[ns]').reshape(-1)
+        batch.data = data
+        if data.shape != (len(batch.epochs), len(OrbitStateBatch.COLUMNS)):
+            raise ValueError(f"Data must be an array of shape ({len(batch.epochs)}, {len(OrbitStateBatch.COLUMNS)}).")
+
+        return batch
+
+    @classmethod
+    def fromStates(cls, epochs, states):
+        states = np.asarray(states, dtype=np.float64)
+        return cls(epochs, position=states[:, OrbitStateBatch.POSITION], velocity=states[:, OrbitStateBatch.VELOCITY])
+
+    @classmethod
+    def fromSourceData(cls, data):
+        epochs = data['index']
+        columns = np.column_stack([data[c] if c in data else np.full(len(epochs), np.nan)
+                                   for c in OrbitStateBatch.COLUMNS]).astype(np.float64)
+        return cls.fromArray(epochs, columns)
+
+    def toSourceData(self, columns=None, index=None, prefix=''):
+
+        # columns are handed to the ColumnDataSource as array views, unset groups are left out by default.
+        # index replaces the epochs as the index column, e.g. with body names, and prefix is put in front of the
+        # column names so that several batches can share one source
+        if columns is None:
+            columns = [c for k, c in enumerate(OrbitStateBatch.COLUMNS) if not np.all(np.isnan(self.data[:, k]))]
+            columns = columns or OrbitStateBatch.COLUMNS[OrbitStateBatch.POSITION]
+
+        data = dict(index=self.epochs if index is None else index) if not prefix else {}
+        data.update({prefix + c: self.data[:, OrbitStateBatch.COLUMNS.index(c)] for c in columns})
+        return data
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def __getitem__(self, item):
+        # integer and slice indexing return views, fancy indexing returns a copy
+        if isinstance(item, (int, np.integer)):
+            item = slice(item, item + 1 if item != -1 else None)
+        return OrbitStateBatch.fromArray(self.epochs[item], self.data[item])
+
+    def validate(self, values, width, name):
+        values = np.asarray(values, dtype=np.float64)
+        if values.shape != (len(self.epochs), width):
+            raise ValueError(f"{name} must be an array of shape ({len(self.epochs)}, {width}).")
+        return values
+
+    def setPosition(self, position):
+        self.data[:, OrbitStateBatch.POSITION] = self.validate(position, 3, 'Position')
+
+    def setVelocity(self, velocity):
+        self.data[:, OrbitStateBatch.VELOCITY] = self.validate(velocity, 3, 'Velocity')
+
+    def setAttitude(self, attitude):
+
+        attitude = self.validate(attitude, 4, 'Attitude')
+
+        # Check that every attitude is a unit quaternion, a zero quaternion cannot be normalized
+        norm = np.linalg.norm(attitude, axis=1, keepdims=True)
+        if np.any(norm == 0):
+            raise ValueError(f"Attitude has {np.count_nonzero(norm == 0)} zero quaternions.")
+
+        invalid = ~np.isclose(norm[:, 0], 1)
+        if np.any(invalid):
+            warnings.warn(f"{np.count_nonzero(invalid)} input quaternions are not unit quaternions. "
+                          f"Normalizing input...")
+
+        self.data[:, OrbitStateBatch.ATTITUDE] = attitude / norm
+
+    def setRate(self, rate):
+        self.data[:, OrbitStateBatch.RATE] = self.validate(rate, 3, 'Rate')
+
+    def getPosition(self):
+        return self.data[:, OrbitStateBatch.POSITION]
+
+    def getVelocity(self):
+        return self.data[:, OrbitStateBatch.VELOCITY]
+
+    def getAttitude(self):
+        return self.data[:, OrbitStateBatch.ATTITUDE]
+
+    def getRate(self):
+        return self.data[:, OrbitStateBatch.RATE]
+
+    def getEpochs(self):
+        return self.epochs
+
+    def getState(self, k):
+        groups = [self.data[k, group] for group in [OrbitStateBatch.POSITION, OrbitStateBatch.VELOCITY,
+                                                    OrbitStateBatch.ATTITUDE, OrbitStateBatch.RATE]]
+        position, velocity, attitude, rate = [None if np.any(np.isnan(g)) else g.tolist() for g in groups]
+        state = OrbitState(position, velocity, None, rate, epoch=self.epochs[k].astype('datetime64[us]').item())
+
+        # the batch already holds unit quaternions, so they are copied without OrbitState's exact norm check
+        if attitude is not None:
+            state.qs, state.qx, state.qy, state.qz = attitude
+
+        return state
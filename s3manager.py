@@ -1,14 +1,21 @@
-from boto3.session import Session
 import os
 import re
 
-ACCESS_KEY = os.environ['AWS_ACCESS_KEY_ID']
-SECRET_KEY = os.environ['AWS_SECRET_ACCESS_KEY']
-S3_BUCKET = os.environ['S3_BUCKET_NAME']
+# KERNEL_SOURCE=local uses the kernels already on disk, e.g. the synthetic kernels written by loadtest.py.
+# META_KERNEL then replaces the meta kernel of every model.
+LOCAL = os.environ.get('KERNEL_SOURCE', 's3') == 'local'
+META_KERNEL = os.environ.get('META_KERNEL')
 
-session = Session(aws_access_key_id=ACCESS_KEY, aws_secret_access_key=SECRET_KEY)
-s3 = session.resource('s3')
-bucket = s3.Bucket(S3_BUCKET)
+if not LOCAL:
+    from boto3.session import Session
+
+    ACCESS_KEY = os.environ['AWS_ACCESS_KEY_ID']
+    SECRET_KEY = os.environ['AWS_SECRET_ACCESS_KEY']
+    S3_BUCKET = os.environ['S3_BUCKET_NAME']
+
+    session = Session(aws_access_key_id=ACCESS_KEY, aws_secret_access_key=SECRET_KEY)
+    s3 = session.resource('s3')
+    bucket = s3.Bucket(S3_BUCKET)
 
 keywords = re.compile(r"KERNELS_TO_LOAD\s*=\s*\((.*)\)", flags=re.DOTALL)
 config = dict(kernel=None, kernel_list=[])
@@ -16,6 +23,10 @@ config = dict(kernel=None, kernel_list=[])
 
 def get_meta_kernel(kernel):
 
+    # returns the meta kernel to furnish
+    if LOCAL:
+        return META_KERNEL or kernel
+
     get_kernel(kernel)
     with open(kernel, 'r') as f:
         contents = f.read()
@@ -39,9 +50,14 @@ def get_meta_kernel(kernel):
         config['kernel'] = kernel
         config['kernel_list'] = kernel_list
 
+    return kernel
+
 
 def remove_meta_kernel(kernel):
 
+    if LOCAL:
+        return
+
     with open(kernel, 'r') as f:
         contents = f.read()
 